@@ -1,26 +1,49 @@
 # retriever_server.py  (drop-in)
-import os, re, json, time, argparse, queue
-from urllib.parse import urljoin, urlparse
+import os, re, json, time, pickle, hashlib, argparse, threading
+from urllib.parse import urljoin, urlparse, urlunparse, parse_qsl, urlencode
+from urllib.robotparser import RobotFileParser
+from html import unescape
 from pathlib import Path
-from collections import Counter
-
+from collections import Counter, defaultdict, deque
+from itertools import chain
+from functools import lru_cache
+from contextlib import asynccontextmanager
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import orjson
+import lxml.etree
+import lxml.html
 import requests
 import trafilatura
-from bs4 import BeautifulSoup
+import zstandard
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from unidecode import unidecode
-from rapidfuzz import fuzz
+from rapidfuzz import fuzz, process
 
-from fastapi import FastAPI, Query
+from fastapi import FastAPI, Query, Response
+from fastapi.responses import ORJSONResponse
 
 # -----------------------
 # Archivos de la KB
 # -----------------------
 BUILD_DIR   = Path("./build")
 CHUNKS_FILE = BUILD_DIR / "chunks.jsonl"
+CHUNKS_PKL  = BUILD_DIR / "chunks.pkl.zst"   # copia binaria de chunks.jsonl para arranques en frío
 INDEX_FILE  = BUILD_DIR / "kb.index"
 MODEL_FILE  = BUILD_DIR / "model.json"
 
-app = FastAPI(title="ByCariola Retriever", version="2.0.0")
+@asynccontextmanager
+async def lifespan(app):
+    # el índice se carga al arrancar el server, no al importar el módulo:
+    # crawler.py (o un --build) importa esto sin pagar la carga del corpus
+    load_docs()
+    yield
+
+app = FastAPI(title="ByCariola Retriever", version="2.0.0", default_response_class=ORJSONResponse,
+              lifespan=lifespan)
 
 # -----------------------
 # Config vía entorno
@@ -31,20 +54,59 @@ DEFAULT_EXCLUDE = r"(/blogs/|/cart|/account|/search|\?variant=|\.json$)"
 INCLUDE_PATTERNS = os.getenv("INCLUDE_PATTERNS", DEFAULT_INCLUDE).split("||")
 EXCLUDE_PATTERNS = os.getenv("EXCLUDE_PATTERNS", DEFAULT_EXCLUDE).split("||")
 
+# regex compiladas una sola vez. Una por patrón (no una alternancia fusionada): los patrones
+# del entorno pueden traer flags inline ((?i)...) o backreferences propias
+_INCLUDE_RES = [re.compile(p) for p in INCLUDE_PATTERNS]
+_EXCLUDE_RES = [re.compile(p) for p in EXCLUDE_PATTERNS]
+_ASSET_RE   = re.compile(r"\.(png|jpe?g|gif|svg|webp|pdf|mp4|css|js|woff2?)($|\?)", re.I)
+_WS_RE      = re.compile(r"\s+")
+_TOKEN_RE   = re.compile(r"[a-zA-Z0-9áéíóúñ]+", re.I)
+# solo el atributo href de un <a>: nada de data-href= ni de location.href = "..." dentro de un <script>;
+# valor con comillas dobles, simples o sin comillas
+_HREF_RE    = re.compile(r"""<a\s(?:[^>]*?\s)?href\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""", re.I)
+_TITLE_RE   = re.compile(r"<title[^>]*>(.*?)</title>", re.I | re.S)
+
 SEED_URLS       = [s.strip() for s in os.getenv("SEED_URLS",
                      "https://by-cariola.com/collections/all,https://by-cariola.com/products").split(",") if s.strip()]
 ALLOWED_DOMAINS = [d.strip() for d in os.getenv("ALLOWED_DOMAINS", "by-cariola.com").split(",") if d.strip()]
 MAX_PAGES       = int(os.getenv("MAX_PAGES", "600"))
+CRAWL_WORKERS   = int(os.getenv("CRAWL_WORKERS", "32"))
+PER_HOST_CONNS  = int(os.getenv("PER_HOST_CONNS", "8"))   # descargas simultáneas por host
+PER_HOST_RPS    = float(os.getenv("PER_HOST_RPS", "2"))   # ritmo máximo por host (<= 0 desactiva)
+KEEP_QUERY_PARAMS = {p.strip() for p in os.getenv("KEEP_QUERY_PARAMS", "page").split(",") if p.strip()}
+SIMHASH_MAX_DIST = int(os.getenv("SIMHASH_MAX_DIST", "3"))  # bits de diferencia para near-dup (< 0 desactiva)
 
 UA = {"User-Agent": "ByCariola-Retriever/2.0 (+https://by-cariola.com)"}
 
+# sesión compartida: keep-alive + pool de conexiones por host (evita un TLS handshake por página)
+SESSION = requests.Session()
+SESSION.headers.update(UA)
+_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=max(64, CRAWL_WORKERS),
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504)),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+
 # -----------------------
 # Utilidades de limpieza
 # -----------------------
+# pliegue a ASCII de lo habitual en español, en C vía str.translate (mismo resultado que unidecode)
+_FOLD = str.maketrans({
+    "á": "a", "é": "e", "í": "i", "ó": "o", "ú": "u", "ü": "u", "ñ": "n",
+    "Á": "A", "É": "E", "Í": "I", "Ó": "O", "Ú": "U", "Ü": "U", "Ñ": "N",
+    "¿": "?", "¡": "!", "\xa0": " ",
+})
+
 def norm_text(s: str) -> str:
     s = s or ""
-    s = unidecode(s)
-    s = re.sub(r"\s+", " ", s).strip()
+    if not s.isascii():
+        s = s.translate(_FOLD)
+        if not s.isascii():
+            # queda algo fuera de la tabla (comillas tipográficas, emojis…)
+            s = unidecode(s)
+    s = _WS_RE.sub(" ", s).strip()
     return s
 
 def same_domain(u, allowed):
@@ -55,116 +117,293 @@ def same_domain(u, allowed):
     return any(net.endswith(d) for d in allowed)
 
 def is_asset(url: str) -> bool:
-    return bool(re.search(r"\.(png|jpe?g|gif|svg|webp|pdf|mp4|css|js|woff2?)($|\?)", url, re.I))
+    return bool(_ASSET_RE.search(url))
 
 def is_included(url: str) -> bool:
-    if any(re.search(p, url) for p in EXCLUDE_PATTERNS):
+    if any(r.search(url) for r in _EXCLUDE_RES):
         return False
-    return any(re.search(p, url) for p in INCLUDE_PATTERNS)
+    return any(r.search(url) for r in _INCLUDE_RES)
 
-def extract_links(html: str, base: str):
-    soup = BeautifulSoup(html, "lxml")
-    out = set()
-    for a in soup.select("a[href]"):
-        href = a.get("href")
+def crawlable(url: str, allowed_domains) -> bool:
+    if is_asset(url):
+        return False
+    if not same_domain(url, allowed_domains):
+        return False
+    # si no cumple include, no lo indexamos ni expandimos
+    return is_included(url)
+
+def canonical_url(url: str) -> str:
+    # fuera el fragmento y los parámetros que no cambian el contenido (sort_by, utm_*, ...);
+    # solo se conservan los de KEEP_QUERY_PARAMS (paginación ?page=N)
+    p = urlparse(url)
+    if p.query:
+        p = p._replace(query=urlencode([(k, v) for k, v in parse_qsl(p.query, keep_blank_values=True)
+                                        if k in KEEP_QUERY_PARAMS]))
+    return urlunparse(p._replace(fragment=""))
+
+def extract_links(html: str, base: str, allowed_domains):
+    # regex sobre el HTML crudo: sin árbol DOM. Se filtra aquí mismo, así assets y URLs
+    # fuera del include nunca llegan a la cola. dict (no set): sin duplicados y en el orden del
+    # documento, así el orden de encolado no depende del hash de los strings
+    out = {}
+    for dq, sq, bare in _HREF_RE.findall(html):
+        href = unescape(dq or sq or bare).split("#", 1)[0].strip()
         if not href:
             continue
-        u = urljoin(base, href).split("#")[0]
-        out.add(u)
-    return out
+        u = urljoin(base, href)
+        if crawlable(u, allowed_domains):
+            out[canonical_url(u)] = None
+    return list(out)
+
+def extract_title(html: str):
+    m = _TITLE_RE.search(html)
+    return unescape(m.group(1)).strip() if m else ""
+
+_INVISIBLE_TAGS = ("script", "style", "noscript", "template", lxml.etree.Comment)
+
+def html_to_text(html: str):
+    # fallback cuando trafilatura no devuelve nada: todo el texto visible del árbol.
+    # Bytes + encoding explícito: lxml rechaza un str con declaración <?xml encoding=...?>
+    try:
+        root = lxml.html.fromstring(html.encode("utf-8"), parser=lxml.html.HTMLParser(encoding="utf-8"))
+    except:
+        return ""
+    # fuera JS, CSS, JSON-LD y comentarios (list(): no se modifica el árbol mientras se itera)
+    for el in list(root.iter(*_INVISIBLE_TAGS)):
+        el.drop_tree()
+    return " ".join(root.itertext())
 
 def fetch_html(url: str):
     try:
-        r = requests.get(url, timeout=15, headers=UA)
+        r = SESSION.get(url, timeout=15)
         if r.status_code >= 400:
             return None
         return r.text
     except:
         return None
 
-def fetch_clean_text(url: str):
+def extract_clean_text(html: str):
     try:
-        downloaded = trafilatura.fetch_url(url)
-        if not downloaded:
-            return ""
-        # extrae texto limpio (sin tablas/comentarios)
-        text = trafilatura.extract(downloaded, include_comments=False, include_tables=False) or ""
+        # extrae texto limpio (sin tablas/comentarios) del HTML ya descargado
+        text = trafilatura.extract(html, include_comments=False, include_tables=False) or ""
         return text
     except:
         return ""
 
 # -----------------------
-# Crawler + build de KB
+# Cortesía por host
 # -----------------------
-def crawl_and_build(seeds, allowed_domains, max_pages=200):
-    visited = set()
-    encola   = queue.Queue()
-    for s in seeds:
-        encola.put(s)
+_host_slots   = defaultdict(lambda: threading.BoundedSemaphore(PER_HOST_CONNS))
+_host_buckets = {}   # netloc -> (tokens, last_refill_ts)
+_host_lock    = threading.Lock()
+_robots       = {}   # netloc -> RobotFileParser | None (None = sin restricciones)
+_robots_locks = defaultdict(threading.Lock)   # un lock por host para la descarga de robots.txt
+_robots_lock  = threading.Lock()              # solo protege _robots_locks
+
+def host_slot(url: str):
+    # limita las descargas simultáneas contra un mismo host
+    with _host_lock:
+        return _host_slots[urlparse(url).netloc]
+
+def host_throttle(url: str):
+    """Token bucket por host: bloquea lo justo para no pasar de PER_HOST_RPS."""
+    if PER_HOST_RPS <= 0:
+        return
+    capacity = max(1.0, PER_HOST_RPS)
+    net = urlparse(url).netloc
+    with _host_lock:
+        now = time.monotonic()
+        tokens, last = _host_buckets.get(net, (capacity, now))
+        # reservamos el token ya (puede quedar negativo) y dormimos fuera del lock
+        tokens = min(capacity, tokens + (now - last) * PER_HOST_RPS) - 1
+        _host_buckets[net] = (tokens, now)
+    if tokens < 0:
+        time.sleep(-tokens / PER_HOST_RPS)
+
+def fetch_robots(url: str):
+    """Devuelve (RobotFileParser | None, transitorio). None = sin restricciones."""
+    # criterio de RobotFileParser.read() / RFC 9309: 4xx => sin restricciones (salvo 401/403);
+    # 5xx o host inalcanzable => no se crawlea nada de ese host, pero es transitorio (no se cachea)
+    p = urlparse(url)
+    host_throttle(url)
+    rp = RobotFileParser()
+    try:
+        r = SESSION.get(f"{p.scheme}://{p.netloc}/robots.txt", timeout=15)
+    except:
+        # incluye el RetryError de urllib3 cuando los reintentos por 5xx se agotan
+        rp.disallow_all = True
+        return rp, True
+    if r.status_code >= 500:
+        rp.disallow_all = True
+        return rp, True
+    if r.status_code in (401, 403):
+        rp.disallow_all = True
+    elif r.status_code >= 400:
+        return None, False
+    else:
+        rp.parse(r.text.splitlines())
+    return rp, False
+
+def reset_robots():
+    # la cache de robots.txt vive lo que dura un crawl: cada rebuild vuelve a leerlos
+    with _robots_lock:
+        _robots.clear()
+        _robots_locks.clear()
+
+def robots_allowed(url: str) -> bool:
+    net = urlparse(url).netloc
+    with _robots_lock:
+        host_lock = _robots_locks[net]
+    with host_lock:
+        # una descarga por host; solo esperan los workers de ese mismo host
+        if net in _robots:
+            rp = _robots[net]
+        else:
+            rp, transient = fetch_robots(url)
+            # un fallo transitorio deniega esta URL y la siguiente del host lo reintenta
+            if not transient:
+                _robots[net] = rp
+    return rp is None or rp.can_fetch(UA["User-Agent"], url)
+
+def crawl_page(url: str, allowed_domains):
+    """Descarga y procesa una URL (corre en el pool). Devuelve (doc|None, links)."""
+    if not robots_allowed(url):
+        return None, ()
+    host_throttle(url)
+    with host_slot(url):
+        html = fetch_html(url)
+    if not html:
+        return None, ()
 
-    docs = []  # [{doc_id,title,body,url}]
-    while not encola.empty() and len(visited) < max_pages:
-        url = encola.get()
-        if url in visited: 
-            continue
-        visited.add(url)
+    # texto principal
+    text = extract_clean_text(html)
+    if not text:
+        text = html_to_text(html)
 
-        if not same_domain(url, allowed_domains): 
-            continue
-        if is_asset(url): 
-            continue
-        if not is_included(url):
-            # si no cumple include, no lo indexamos ni expandimos
-            continue
+    title = extract_title(html) or url
 
-        html = fetch_html(url)
-        if not html:
-            continue
+    body = norm_text(text)
+    title = norm_text(title)
 
-        # texto principal
-        text = fetch_clean_text(url)
-        if not text:
-            soup_raw = BeautifulSoup(html, "lxml")
-            text = soup_raw.get_text(" ", strip=True)
+    if not body or len(body) < 120:
+        return None, ()
 
-        soup = BeautifulSoup(html, "lxml")
-        title = soup.title.get_text(strip=True) if soup.title else url
+    return {"title": title, "body": body, "url": url}, extract_links(html, url, allowed_domains)
 
-        body = norm_text(text)
-        title = norm_text(title)
+def hash64(s: str) -> int:
+    return int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little")
 
-        if not body or len(body) < 120:
-            continue
+def url_key(url: str) -> int:
+    # huella de 64 bits: el set de vistos no guarda el string completo de cada URL
+    return hash64(url)
 
-        docs.append({
-            "doc_id": f"doc_{len(docs)}",
-            "title" : title,
-            "body"  : body,
-            "url"   : url
-        })
+_SIMHASH_BITS = np.arange(64, dtype=np.uint64)
 
-        # seguimos crawleando SOLO los enlaces dentro del include
-        for link in extract_links(html, url):
-            if link in visited: 
-                continue
-            if not same_domain(link, allowed_domains):
-                continue
-            if is_asset(link):
+def simhash(text: str) -> int:
+    """SimHash de 64 bits sobre las palabras del texto, ponderadas por frecuencia."""
+    tf = Counter(text.lower().split())
+    if not tf:
+        return 0
+    h = np.fromiter((hash64(t) for t in tf), dtype=np.uint64, count=len(tf))
+    w = np.fromiter(tf.values(), dtype=np.float64, count=len(tf))
+    bits = ((h[:, None] >> _SIMHASH_BITS) & np.uint64(1)).astype(np.float64)
+    v = w @ (2 * bits - 1)
+    return sum(1 << int(i) for i in np.flatnonzero(v > 0))
+
+def is_near_dup(seen_bodies, title: str, body: str) -> bool:
+    """True si ya hay un cuerpo indexado con el mismo título a <= SIMHASH_MAX_DIST bits; si no, lo registra."""
+    if SIMHASH_MAX_DIST < 0:
+        return False
+    h = simhash(body)
+    near = seen_bodies[title]
+    if any(bin(h ^ o).count("1") <= SIMHASH_MAX_DIST for o in near):
+        return True
+    near.append(h)
+    return False
+
+# -----------------------
+# Crawler + build de KB
+# -----------------------
+def crawl_and_build(seeds, allowed_domains, max_pages=200):
+    # se marca al encolar, así una URL entra una sola vez en la cola. La cola es FIFO y cada URL
+    # entra una vez: solo las primeras max_pages URLs vistas llegan a despacharse, así que seen
+    # (y con él la cola) se corta ahí sin cambiar qué se crawlea => memoria O(max_pages)
+    reset_robots()
+    seen     = set()
+    visited  = 0
+    encola   = deque()   # solo la toca el hilo coordinador: no necesita locks
+    for s in seeds:
+        if not crawlable(s, allowed_domains):
+            continue
+        s = canonical_url(s)
+        key = url_key(s)
+        if key not in seen and len(seen) < max_pages:
+            seen.add(key)
+            encola.append(s)
+
+    pages = []  # [{title,body,url}] en orden de despacho
+    with ThreadPoolExecutor(max_workers=CRAWL_WORKERS) as pool:
+        in_flight = deque()   # futures en orden de envío
+        while True:
+            # despacha trabajo mientras haya cola y presupuesto de páginas
+            while encola and visited < max_pages:
+                url = encola.popleft()
+                visited += 1
+                in_flight.append(pool.submit(crawl_page, url, allowed_domains))
+
+            if not in_flight:
+                break
+
+            # resultados en orden de envío, no de llegada: qué URLs entran en seen antes de llegar
+            # al tope (y por tanto qué se crawlea) no depende de qué hilo termina antes.
+            # Los demás workers siguen descargando mientras se espera a la cabeza.
+            # seen/encola/pages solo se tocan desde este hilo
+            doc, links = in_flight.popleft().result()
+            if doc is None:
                 continue
-            if is_included(link):
-                encola.put(link)
+
+            pages.append(doc)
+
+            # los links ya vienen filtrados (include/dominio/assets) y canonicalizados
+            for link in links:
+                if len(seen) >= max_pages:
+                    break
+                key = url_key(link)
+                if key not in seen:
+                    seen.add(key)
+                    encola.append(link)
+
+    # orden por URL antes de numerar y deduplicar: doc_ids, orden de _DOCS (desempate del
+    # ranking) y copia que sobrevive a la dedupe no dependen del orden en que terminan los hilos
+    pages.sort(key=lambda d: d["url"])
+
+    docs = []  # [{doc_id,title,body,url}]
+    # simhashes ya indexados, por título: las variantes (?variant=, paginación, etc.) comparten
+    # título; productos distintos con la misma descripción genérica no se descartan
+    seen_bodies = defaultdict(list)
+    for doc in pages:
+        # un near-duplicado no se indexa (sus enlaces ya se siguieron durante el crawl)
+        if not is_near_dup(seen_bodies, doc["title"], doc["body"]):
+            docs.append({"doc_id": f"doc_{len(docs)}", **doc})
 
     BUILD_DIR.mkdir(parents=True, exist_ok=True)
 
-    with CHUNKS_FILE.open("w", encoding="utf-8") as f:
-        for d in docs:
-            f.write(json.dumps(d, ensure_ascii=False) + "\n")
+    # un solo blob => un write() grande y un fsync al final
+    payload = b"".join(orjson.dumps(d, option=orjson.OPT_APPEND_NEWLINE) for d in docs)
+    with CHUNKS_FILE.open("wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+
+    # tuplas planas (no Doc): el pickle no depende de cómo se importó este módulo
+    rows = [(d["doc_id"], d["title"], d["body"], d["url"]) for d in docs]
+    CHUNKS_PKL.write_bytes(
+        zstandard.ZstdCompressor(level=3).compress(pickle.dumps(rows, protocol=pickle.HIGHEST_PROTOCOL)))
 
-    vocab = Counter()
-    for d in docs:
-        tokens = re.findall(r"[a-zA-Z0-9áéíóúñ]+", d["title"] + " " + d["body"], flags=re.I)
-        for t in tokens:
-            vocab[unidecode(t.lower())] += 1
+    # title/body ya pasaron por norm_text (ASCII): un lower() y un findall sobre todo el corpus,
+    # y Counter cuenta en C
+    blob = " ".join(d["title"] + " " + d["body"] for d in docs).lower()
+    vocab = Counter(_TOKEN_RE.findall(blob))
 
     with INDEX_FILE.open("w", encoding="utf-8") as f:
         f.write(json.dumps({"size": len(docs), "vocab_size": len(vocab)}, ensure_ascii=False))
@@ -177,47 +416,158 @@ def crawl_and_build(seeds, allowed_domains, max_pages=200):
 # -----------------------
 # Búsqueda en memoria
 # -----------------------
-_DOCS = []
+BM25_K1    = 1.2
+BM25_B     = 0.75
+RERANK_TOP = int(os.getenv("RERANK_TOP", "50"))   # candidatos BM25 que pasan al re-ranking fuzzy
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "512"))
+
+class Doc(NamedTuple):
+    """Doc del corpus en memoria (inmutable, sin dict por instancia)."""
+    doc_id: str
+    title : str
+    body  : str
+    url   : str
+
+class Index(NamedTuple):
+    """Corpus + índice en memoria. Inmutable: load_docs arma uno nuevo y lo publica con una
+    sola asignación, así una búsqueda en curso nunca mezcla el corpus viejo con el nuevo."""
+    gen      : int          # generación del corpus (parte de la clave del cache de /search)
+    docs     : list         # [Doc]
+    titles   : list         # títulos en minúsculas, alineados con docs
+    bodies   : list         # cuerpos en minúsculas, alineados con docs
+    url_boost: np.ndarray   # boost por tipo de URL, constante por doc
+    vocab    : dict         # término -> term id
+    # postings en CSR: los del término t ocupan [offsets[t], offsets[t+1])
+    offsets  : np.ndarray
+    post_docs: np.ndarray
+    post_w   : np.ndarray   # idf * saturación tf/longitud, precalculado
+
+_INDEX = Index(0, [], [], [], np.zeros(0, dtype=np.float32), {},
+               np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32))
+
+def tokenize(s: str):
+    return _TOKEN_RE.findall(s.lower())
+
+def build_index(titles, bodies):
+    """Índice invertido BM25 (CSR) sobre título + cuerpo (ya en minúsculas) de cada doc."""
+    postings = defaultdict(lambda: ([], []))
+    doc_len = np.zeros(len(titles), dtype=np.float32)
+    for i, (title, body) in enumerate(zip(titles, bodies)):
+        tf = Counter(_TOKEN_RE.findall(title + " " + body))
+        doc_len[i] = sum(tf.values())
+        for t, c in tf.items():
+            ids, tfs = postings[t]
+            ids.append(i)
+            tfs.append(c)
+
+    n = len(titles)
+    avgdl = float(doc_len.mean()) if n else 0.0
+    vocab = {t: tid for tid, t in enumerate(postings)}
+    df = np.fromiter((len(ids) for ids, _ in postings.values()), dtype=np.int64, count=len(vocab))
+    offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    np.cumsum(df, out=offsets[1:])
+    post_docs = np.fromiter(chain.from_iterable(ids for ids, _ in postings.values()), dtype=np.int32, count=offsets[-1])
+    post_tf = np.fromiter(chain.from_iterable(tfs for _, tfs in postings.values()), dtype=np.float32, count=offsets[-1])
+
+    # el peso BM25 de cada posting no depende de la query: se calcula una vez aquí
+    idf = np.log1p((n - df + 0.5) / (df + 0.5)).astype(np.float32)
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_len / (avgdl or 1.0))
+    post_w = np.repeat(idf, df) * (BM25_K1 + 1) * post_tf / (post_tf + norm[post_docs])
+    return vocab, offsets, post_docs, post_w.astype(np.float32)
+
+def url_boost(url: str) -> float:
+    boost = 0.0
+    if "/products/" in url:
+        boost += 6.0     # BOOST productos
+    if "/collections/" in url:
+        boost += 3.0
+    if "/blogs/" in url:
+        boost -= 4.0     # PENALIZA blog
+    return boost
 
-def load_docs():
-    global _DOCS
-    _DOCS = []
+def read_docs():
     if not CHUNKS_FILE.exists():
-        return
-    with CHUNKS_FILE.open("r", encoding="utf-8") as f:
+        return []
+
+    # la copia .pkl.zst solo vale si no es más vieja que el .jsonl (que es el canónico)
+    if CHUNKS_PKL.exists() and CHUNKS_PKL.stat().st_mtime >= CHUNKS_FILE.stat().st_mtime:
+        try:
+            rows = pickle.loads(zstandard.ZstdDecompressor().decompress(CHUNKS_PKL.read_bytes()))
+            return [Doc(*r) for r in rows]
+        except:
+            pass
+
+    docs = []
+    with CHUNKS_FILE.open("rb") as f:
         for line in f:
             try:
-                _DOCS.append(json.loads(line))
+                d = orjson.loads(line)
+                docs.append(Doc(d["doc_id"], d["title"], d["body"], d.get("url", "")))
             except:
                 pass
+    return docs
 
-def score_doc(q: str, d: dict) -> float:
-    ql = q.lower()
-    title = d["title"].lower()
-    body  = d["body"].lower()
-
-    s1 = fuzz.partial_ratio(ql, title)
-    s2 = fuzz.partial_ratio(ql, body)
-    score = s1 * 1.5 + s2 * 0.7
-
-    url = d.get("url", "")
-    if "/products/" in url:
-        score += 6.0     # BOOST productos
-    if "/collections/" in url:
-        score += 3.0
-    if "/blogs/" in url:
-        score -= 4.0     # PENALIZA blog
-
-    return score
+def load_docs():
+    global _INDEX
+    docs = read_docs()
+    # todo lo que es constante por doc se calcula aquí, no en cada query
+    titles = [d.title.lower() for d in docs]
+    bodies = [d.body.lower() for d in docs]
+    vocab, offsets, post_docs, post_w = build_index(titles, bodies)
+    boost = np.fromiter((url_boost(d.url) for d in docs), dtype=np.float32, count=len(docs))
+    _INDEX = Index(_INDEX.gen + 1, docs, titles, bodies, boost, vocab, offsets, post_docs, post_w)
+    # las entradas viejas ya no son alcanzables (la generación va en la clave); solo liberamos memoria
+    _search_payload.cache_clear()
+
+def bm25_scores(ix: Index, tids):
+    """Kernel BM25: suma por doc los pesos precalculados de los postings de cada término."""
+    if not tids:
+        return np.zeros(len(ix.docs), dtype=np.float32)
+    docs = np.concatenate([ix.post_docs[ix.offsets[t]:ix.offsets[t + 1]] for t in tids])
+    w    = np.concatenate([ix.post_w[ix.offsets[t]:ix.offsets[t + 1]] for t in tids])
+    return np.bincount(docs, weights=w, minlength=len(ix.docs))
+
+def bm25_candidates(ix: Index, q: str, k: int):
+    """Índices (en orden de ix.docs) de los k docs con mejor BM25 > 0."""
+    tids = [ix.vocab[t] for t in set(tokenize(q)) if t in ix.vocab]
+    scores = bm25_scores(ix, tids)
+
+    hit = np.flatnonzero(scores)
+    if len(hit) > k:
+        hit = np.sort(hit[np.argpartition(scores[hit], -k)[-k:]])
+    return hit
+
+def _search_ranked(ix: Index, ql: str, top_k: int):
+    # BM25 preselecciona; el fuzzy solo re-rankea esos candidatos
+    cand = bm25_candidates(ix, ql, max(RERANK_TOP, top_k))
+    # pocas coincidencias léxicas (p.ej. typos): volvemos al scan fuzzy completo
+    if len(cand) < top_k:
+        cand = np.arange(len(ix.docs))
+    k = min(top_k, len(cand))
+    if k <= 0:
+        return []
+
+    # una llamada a C por campo en vez de un partial_ratio por doc
+    s1 = process.cdist([ql], [ix.titles[i] for i in cand], scorer=fuzz.partial_ratio, dtype=np.float32)[0]
+    s2 = process.cdist([ql], [ix.bodies[i] for i in cand], scorer=fuzz.partial_ratio, dtype=np.float32)[0]
+    scores = s1 * 1.5 + s2 * 0.7
+    scores += ix.url_boost[cand]
+
+    # orden estable: a igual score gana el doc que aparece antes en ix.docs
+    top = np.argsort(-scores, kind="stable")[:k]
+    # vista recortada nueva por hit; los Doc son inmutables
+    hits = [ix.docs[cand[i]] for i in top]
+    return [{"doc_id": d.doc_id, "title": d.title, "body": d.body[:900], "url": d.url} for d in hits]
 
 def search_docs(query, top_k=6):
-    q = norm_text(query)
-    scored = [(score_doc(q, d), d) for d in _DOCS]
-    scored.sort(key=lambda x: x[0], reverse=True)
-    hits = [d for _, d in scored[:top_k]]
-    for h in hits:
-        h["body"] = h["body"][:900]
-    return hits
+    return _search_ranked(_INDEX, norm_text(query).lower(), top_k)
+
+@lru_cache(maxsize=SEARCH_CACHE_SIZE)
+def _search_payload(gen: int, ql: str, top_k: int) -> bytes:
+    # se cachea la respuesta ya serializada: un HIT no vuelve a pasar por el encoder.
+    # gen en la clave: un resultado calculado sobre un corpus viejo nunca se sirve tras un rebuild
+    # (la generación solo crece, así que lo guardado bajo gen nunca es más viejo que gen)
+    return orjson.dumps({"results": _search_ranked(_INDEX, ql, top_k)})
 
 # -----------------------
 # Endpoints FastAPI
@@ -225,16 +575,24 @@ def search_docs(query, top_k=6):
 @app.get("/healthz")
 def healthz():
     ok = CHUNKS_FILE.exists() and INDEX_FILE.exists() and MODEL_FILE.exists()
-    return {"ok": ok, "docs": len(_DOCS)}
+    return {"ok": ok, "docs": len(_INDEX.docs)}
 
 @app.get("/search")
 def search(q: str = Query(..., min_length=2), top_k: int = 6):
-    return {"results": search_docs(q, top_k=top_k)}
+    hits_before = _search_payload.cache_info().hits
+    payload = _search_payload(_INDEX.gen, norm_text(q).lower(), top_k)
+    cache = "HIT" if _search_payload.cache_info().hits > hits_before else "MISS"
+    return Response(content=payload, media_type="application/json", headers={"X-Cache": cache})
+
+_rebuild_lock = threading.Lock()
 
 @app.post("/rebuild")
 def rebuild():
-    n = crawl_and_build(SEED_URLS, ALLOWED_DOMAINS, MAX_PAGES)
-    load_docs()
+    # endpoint sync: FastAPI lo corre en su threadpool, el event loop sigue atendiendo /search.
+    # Un rebuild a la vez: dos crawls en paralelo pisarían los archivos de build/
+    with _rebuild_lock:
+        n = crawl_and_build(SEED_URLS, ALLOWED_DOMAINS, MAX_PAGES)
+        load_docs()
     return {"rebuilt": True, "docs": n}
 
 # -----------------------
@@ -259,8 +617,5 @@ def cli_build():
 if __name__ == "__main__":
     ran = cli_build()
     if not ran:
-        load_docs()
         import uvicorn
         uvicorn.run("retriever_server:app", host="0.0.0.0", port=int(os.getenv("PORT", "10000")))
-else:
-    load_docs()